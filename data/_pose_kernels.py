@@ -0,0 +1,56 @@
+import numpy as np
+from numba import njit
+
+@njit(fastmath=True, cache=True)
+def _relative_xz(pose_slab, row, rot, t_cur, out, out_row):
+    # X/Z of R_cur^T (t_row - t_cur), i.e. the translation of inv(M_cur) @ M_row
+    dx = pose_slab[row, 0] - t_cur[0]
+    dy = pose_slab[row, 1] - t_cur[1]
+    dz = pose_slab[row, 2] - t_cur[2]
+    out[out_row, 0] = rot[0, 0] * dx + rot[1, 0] * dy + rot[2, 0] * dz
+    out[out_row, 1] = rot[0, 2] * dx + rot[1, 2] * dy + rot[2, 2] * dz
+
+@njit(fastmath=True, cache=True)
+def transform_all(pose_slab, ctx, wp_start, wp_len, target_idx_rel, out_in_xz, out_wp_xz, out_tgt_xz):
+    """
+    Express the input, waypoint and target positions of one sample in the frame of the
+    current pose and keep only X and Z. Only the rotation of the current pose is needed,
+    so the other quaternions are never converted.
+
+    Args:
+        pose_slab: (M, 7) poses (tx, ty, tz, qx, qy, qz, qw) starting at the first input pose
+        ctx: number of input poses, the current pose is row ctx - 1
+        wp_start: row of the first waypoint
+        wp_len: number of waypoints
+        target_idx_rel: target row relative to the first future pose (row ctx)
+        out_in_xz: (ctx, 2) output for the input positions
+        out_wp_xz: (wp_len, 2) output for the waypoints
+        out_tgt_xz: (1, 2) output for the target position
+    """
+    # Reads below are unchecked, so an out-of-range sample must fail here instead of reading past the slab
+    n = pose_slab.shape[0]
+    if ctx < 1 or ctx > n or wp_start < 0 or wp_start + wp_len > n or target_idx_rel < 0 or ctx + target_idx_rel >= n:
+        raise IndexError("transform_all: sample rows out of range of pose_slab")
+    cur = ctx - 1
+    qx = pose_slab[cur, 3]
+    qy = pose_slab[cur, 4]
+    qz = pose_slab[cur, 5]
+    qw = pose_slab[cur, 6]
+    s = 2.0 / (qx * qx + qy * qy + qz * qz + qw * qw)
+    rot = np.empty((3, 3), dtype=pose_slab.dtype)
+    rot[0, 0] = 1 - s * (qy * qy + qz * qz)
+    rot[0, 1] = s * (qx * qy - qw * qz)
+    rot[0, 2] = s * (qx * qz + qw * qy)
+    rot[1, 0] = s * (qx * qy + qw * qz)
+    rot[1, 1] = 1 - s * (qx * qx + qz * qz)
+    rot[1, 2] = s * (qy * qz - qw * qx)
+    rot[2, 0] = s * (qx * qz - qw * qy)
+    rot[2, 1] = s * (qy * qz + qw * qx)
+    rot[2, 2] = 1 - s * (qx * qx + qy * qy)
+    t_cur = pose_slab[cur, :3]
+
+    for i in range(ctx):
+        _relative_xz(pose_slab, i, rot, t_cur, out_in_xz, i)
+    for i in range(wp_len):
+        _relative_xz(pose_slab, wp_start + i, rot, t_cur, out_wp_xz, i)
+    _relative_xz(pose_slab, ctx + target_idx_rel, rot, t_cur, out_tgt_xz, 0)
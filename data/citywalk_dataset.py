@@ -1,32 +1,81 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pandas as pd
 import torch
-from torch.utils.data import Dataset, Sampler
+from torch.utils.data import Dataset, DistributedSampler
 import torchvision.transforms.functional as TF
 from decord import VideoReader, cpu
+from decord.bridge import use_torch
 from tqdm import tqdm
-from scipy.spatial.transform import Rotation as R
-import random
-
-class CityWalkSampler(Sampler):
-    def __init__(self, dataset):
-        self.dataset = dataset
-        self.indices = self.create_indices()
-
-    def create_indices(self):
-        indices = []
-        for start_idx, end_idx in self.dataset.video_ranges:
-            video_indices = list(range(start_idx, end_idx))
+from data.data_utils import RandomPool, write_cache
+from data._pose_kernels import transform_all
+
+class CityWalkSampler(DistributedSampler):
+    """
+    Yields the indices of one video after another. In train mode indices are shuffled within
+    bounded buffers of each video, so no full list of indices is materialized per epoch.
+
+    Videos are split into one stream per DataLoader worker of every rank (num_replicas * num_workers
+    streams), balanced by sample count. Each rank emits one full batch of each of its streams in turn,
+    and the DataLoader hands batches to its workers round-robin, so every worker only decodes the videos
+    of its own stream and keeps reusing its VideoReader. Shorter streams wrap around to their own first
+    samples, so all streams yield the same number of batches and no worker ever takes over another's.
+
+    Being a DistributedSampler, it is used as is under DDP instead of being wrapped by Lightning.
+    """
+    def __init__(self, dataset, batch_size=1, num_workers=0, num_replicas=1, rank=0, buffer_size=65536):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.buffer_size = buffer_size
+        self.streams = self._split_streams(dataset.video_ranges, self.num_replicas * self.num_workers)
+        stream_sizes = [sum(end_idx - start_idx for start_idx, end_idx in stream) for stream in self.streams]
+        self.batches_per_stream = max(-(-size // batch_size) for size in stream_sizes)
+
+    @staticmethod
+    def _split_streams(video_ranges, num_streams):
+        # Longest video first onto the least loaded stream, then restore file order within each stream
+        loads = [0] * num_streams
+        streams = [[] for _ in range(num_streams)]
+        for video_idx in sorted(range(len(video_ranges)), key=lambda i: video_ranges[i][0] - video_ranges[i][1]):
+            stream_idx = loads.index(min(loads))
+            streams[stream_idx].append(video_idx)
+            loads[stream_idx] += video_ranges[video_idx][1] - video_ranges[video_idx][0]
+        streams = [[video_ranges[i] for i in sorted(stream)] for stream in streams]
+        # With fewer videos than streams, the spare streams repeat the videos of a filled one
+        filled = [stream for stream, load in zip(streams, loads) if load]
+        if not filled:
+            return streams
+        return [stream if load else filled[i % len(filled)] for i, (stream, load) in enumerate(zip(streams, loads))]
+
+    def _video_indices(self, start_idx, end_idx):
+        for buffer_start in range(start_idx, end_idx, self.buffer_size):
+            buffer = np.arange(buffer_start, min(buffer_start + self.buffer_size, end_idx))
             if self.dataset.mode == 'train':
-                random.shuffle(video_indices)
-            indices.extend(video_indices)
-        return indices
+                np.random.shuffle(buffer)
+            yield from buffer.tolist()
+
+    def _stream_batches(self, video_ranges):
+        batch = []
+        while True:
+            for start_idx, end_idx in video_ranges:
+                for idx in self._video_indices(start_idx, end_idx):
+                    batch.append(idx)
+                    if len(batch) == self.batch_size:
+                        yield batch
+                        batch = []
 
     def __iter__(self):
-        return iter(self.indices)
+        first_stream = self.rank * self.num_workers
+        streams = [self._stream_batches(video_ranges)
+                   for video_ranges in self.streams[first_stream:first_stream + self.num_workers]]
+        for _ in range(self.batches_per_stream):
+            for stream in streams:
+                yield from next(stream)
 
     def __len__(self):
-        return len(self.indices)
+        return self.batches_per_stream * self.batch_size * self.num_workers
 
 class CityWalkDataset(Dataset):
     def __init__(self, cfg, mode):
@@ -52,7 +101,6 @@ class CityWalkDataset(Dataset):
             for f in sorted(os.listdir(self.pose_dir))
             if f.endswith('.txt')
         ]
-        print(len(self.pose_path))
         if mode == 'train':
             self.pose_path = self.pose_path[:cfg.data.num_train]
         elif mode == 'val':
@@ -72,15 +120,11 @@ class CityWalkDataset(Dataset):
             self.video_path.append(video)
 
         # Load poses and compute usable counts
-        self.poses = []
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            self.poses = list(tqdm(executor.map(self._load_pose, self.pose_path),
+                                   total=len(self.pose_path), desc="Loading poses"))
         self.count = []
-        for f in tqdm(self.pose_path, desc="Loading poses"):
-            pose = np.loadtxt(f, delimiter=" ")[::max(1, self.pose_fps // self.target_fps), 1:]
-            pose_nan = np.isnan(pose).any(axis=1)
-            if np.any(pose_nan):
-                first_nan_idx = np.argmin(pose_nan)
-                pose = pose[:first_nan_idx]
-            self.poses.append(pose)
+        for pose in self.poses:
             usable = pose.shape[0] - self.context_size - max(self.arrived_threshold*2, self.wp_length)
             self.count.append(max(usable, 0))  # Ensure non-negative
 
@@ -94,33 +138,67 @@ class CityWalkDataset(Dataset):
             step_scale = np.linalg.norm(np.diff(pose[:, [0, 2]], axis=0), axis=1).mean()
             self.step_scale.append(step_scale)
 
-        # Build the look-up table and video_ranges
-        self.lut = []
-        self.video_ranges = []
-        idx_counter = 0
-        for video_idx, count in enumerate(self.count):
-            start_idx = idx_counter
-            interval = self.context_size
-            for pose_start in range(0, count, interval):
-                self.lut.append((video_idx, pose_start))
-                idx_counter += 1
-            end_idx = idx_counter
-            self.video_ranges.append((start_idx, end_idx))
-        assert len(self.lut) > 0, "No usable samples found."
+        # Build the look-up table as two int32 arrays (video index, pose start) and video_ranges
+        interval = self.context_size
+        samples_per_video = np.array([(count + interval - 1) // interval for count in self.count], dtype=np.int64)
+        self.lut_video = np.repeat(np.arange(len(self.count), dtype=np.int32), samples_per_video)
+        self.lut_pose = np.concatenate(
+            [np.arange(0, count, interval, dtype=np.int32) for count in self.count] + [np.empty(0, dtype=np.int32)])
+        end_indices = np.cumsum(samples_per_video)
+        self.video_ranges = list(zip((end_indices - samples_per_video).tolist(), end_indices.tolist()))
+        assert len(self.lut_video) > 0, "No usable samples found."
 
         # Initialize the video reader cache per worker
         self.video_reader_cache = {'video_idx': None, 'video_reader': None}
+        # Per-worker random numbers, seeded in worker_init_fn
+        self._random = RandomPool()
+        # Output buffers of the pose kernel, rows are the input positions followed by the target
+        self._positions_xz = np.empty((self.context_size + 1, 2), dtype=np.float32)
+        self._waypoints_xz = np.empty((self.wp_length, 2), dtype=np.float32)
+        # Compile the pose kernel up front instead of in the first __getitem__. The warm-up runs on real
+        # poses so numba specializes for exactly the dtype, layout and read-only flag seen at runtime
+        transform_all(self.poses[0], self.context_size, self.context_size, self.wp_length, 0,
+                      self._positions_xz[:self.context_size], self._waypoints_xz, self._positions_xz[self.context_size:])
 
     def __len__(self):
-        return len(self.lut)
+        return len(self.lut_video)
+
+    def _load_pose(self, f):
+        """
+        Parse a pose file, subsample it to target_fps and cut it at the first NaN row.
+        The parsed file is cached next to it as float32 .npy so later runs skip the text parsing,
+        and the returned array is a read-only memory map of that cache. When the pose directory
+        is not writable, the parsed poses are returned without caching.
+        """
+        cache_path = f + '.npy'
+        pose = None
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(f):
+            pose = np.load(cache_path, mmap_mode='r')
+        # Only use a cache that holds row-major float32 poses, as written below
+        if pose is None or pose.dtype != np.float32 or not pose.flags.c_contiguous:
+            # to_numpy() is column-major; store rows contiguously so per-sample pose reads are not strided
+            pose = np.ascontiguousarray(
+                pd.read_csv(f, sep=' ', header=None, engine='c', dtype=np.float64).to_numpy(), dtype=np.float32)
+            if write_cache(cache_path, lambda cache_file: np.save(cache_file, pose)):
+                # Memory-map the cache so all workers share the same page cache instead of private copies
+                pose = np.load(cache_path, mmap_mode='r')
+            else:
+                # Read-only dataset directory: keep the parsed poses, read-only like the memory map
+                pose.setflags(write=False)
+        pose = pose[::max(1, self.pose_fps // self.target_fps), 1:]
+        pose_nan = np.isnan(pose).any(axis=1)
+        if np.any(pose_nan):
+            pose = pose[:pose_nan.argmax()]
+        return pose
 
     def __getitem__(self, index):
-        video_idx, pose_start = self.lut[index]
+        video_idx = int(self.lut_video[index])
+        pose_start = int(self.lut_pose[index])
 
         # Retrieve or create the VideoReader for the current video
         if self.video_reader_cache['video_idx'] != video_idx:
             # Replace the old VideoReader with the new one
-            self.video_reader_cache['video_reader'] = VideoReader(self.video_path[video_idx], ctx=cpu(0))
+            self.video_reader_cache['video_reader'] = VideoReader(self.video_path[video_idx], ctx=cpu(0), num_threads=1)
             self.video_reader_cache['video_idx'] = video_idx
         video_reader = self.video_reader_cache['video_reader']
 
@@ -130,10 +208,12 @@ class CityWalkDataset(Dataset):
 
         # Ensure frame indices are within the video length
         num_frames = len(video_reader)
-        frame_indices = [min(idx, num_frames - 1) for idx in frame_indices]
+        np.minimum(frame_indices, num_frames - 1, out=frame_indices)
 
-        # Load the required frames
-        frames = video_reader.get_batch(frame_indices).asnumpy()
+        # Load the required frames as a torch tensor through DLPack, without a copy through numpy. The bridge
+        # is scoped to this call because decord's global bridge would also change other readers' outputs
+        with use_torch():
+            frames = video_reader.get_batch(frame_indices)
 
         # Process frames
         frames = self.process_frames(frames)
@@ -143,42 +223,32 @@ class CityWalkDataset(Dataset):
 
         # Get input and future poses
         input_poses, future_poses = self.get_input_and_future_poses(pose, pose_start)
-        original_input_poses = np.copy(input_poses)  # Store original poses before noise
 
         # Select target pose
-        target_pose, arrived = self.select_target_pose(future_poses)
+        target_idx, arrived = self.select_target_index(future_poses)
 
         # Determine arrived label
         # arrived = self.determine_arrived_label(input_poses[-1, :3], target_pose[:3])
 
-        # Extract waypoints
-        waypoint_poses = self.extract_waypoints(pose, pose_start)
-
-        # # Add noise if necessary
-        # if self.input_noise > 0:
-        #     input_poses = self.add_noise(input_poses)
-
-        # Transform poses
-        current_pose = input_poses[-1]
+        # Transform input, waypoint and target positions into the current pose frame (X and Z only)
+        transform_all(pose[pose_start:], self.context_size, self.context_size, self.wp_length, target_idx,
+                      self._positions_xz[:self.context_size], self._waypoints_xz, self._positions_xz[self.context_size:])
         if self.cfg.model.cord_embedding.type == 'polar':
-            transformed_input_positions = self.input2target(input_poses, target_pose)
+            transformed_input_positions = self.input2target(input_poses, future_poses[target_idx])
         elif self.cfg.model.cord_embedding.type == 'input_target':
-            transformed_input_positions = np.concatenate([
-                self.transform_poses(input_poses, current_pose)[:, [0, 2]], 
-                self.transform_target_pose(target_pose, current_pose)[np.newaxis, [0, 2]]
-            ], axis=0)
+            transformed_input_positions = self._positions_xz
         else:
             raise NotImplementedError(f"Coordinate embedding type {self.cfg.model.cord_embedding} not implemented")
-        waypoints_transformed = self.transform_waypoints(waypoint_poses, current_pose)
 
         # Convert data to tensors
         input_positions = torch.tensor(transformed_input_positions, dtype=torch.float32)
-        waypoints_transformed = torch.tensor(waypoints_transformed[:, [0, 2]], dtype=torch.float32)
+        waypoints_transformed = torch.tensor(self._waypoints_xz, dtype=torch.float32)
         step_scale = torch.tensor(self.step_scale[video_idx], dtype=torch.float32)
         step_scale = torch.clamp(step_scale, min=1e-2)
         input_positions_scaled = input_positions / step_scale
         waypoints_scaled = waypoints_transformed / step_scale
-        input_positions_scaled[:self.context_size-1] += torch.randn(self.context_size-1, 2) * self.input_noise
+        if self.input_noise > 0:
+            self._random.add_noise_(input_positions_scaled[:self.context_size-1], self.input_noise)
         arrived = torch.tensor(arrived, dtype=torch.float32)
         sample = {
             'video_frames': frames,
@@ -190,28 +260,15 @@ class CityWalkDataset(Dataset):
 
         # For visualization during validation
         if self.mode in ['val', 'test']:
-            # vis_input_positions = self.transform_poses(input_poses, current_pose)
-            transformed_original_input_positions = self.transform_poses(original_input_poses, current_pose)
-            target_transformed = self.transform_target_pose(target_pose, current_pose)
-
-            original_input_positions = torch.tensor(transformed_original_input_positions[:, [0, 2]], dtype=torch.float32)
-            # noisy_input_positions = torch.tensor(vis_input_positions[:, [0, 2]], dtype=torch.float32)
+            original_input_positions = torch.tensor(self._positions_xz[:self.context_size], dtype=torch.float32)
             noisy_input_positions = input_positions_scaled[:-1] * step_scale
-            target_transformed_position = torch.tensor(target_transformed[[0, 2]], dtype=torch.float32)  # Only X and Z
+            target_transformed_position = torch.tensor(self._positions_xz[self.context_size], dtype=torch.float32)  # Only X and Z
             sample['original_input_positions'] = original_input_positions
             sample['noisy_input_positions'] = noisy_input_positions
             sample['gt_waypoints'] = waypoints_transformed
             sample['target_transformed'] = target_transformed_position  # Add target coordinate
         return sample
 
-    def transform_poses(self, poses, current_pose_array):
-        current_pose_matrix = self.pose_to_matrix(current_pose_array)
-        current_pose_inv = np.linalg.inv(current_pose_matrix)
-        pose_matrices = self.poses_to_matrices(poses)
-        transformed_matrices = np.matmul(current_pose_inv[np.newaxis, :, :], pose_matrices)
-        positions = transformed_matrices[:, :3, 3]
-        return positions
-
     def get_input_and_future_poses(self, pose, pose_start):
         input_poses = pose[pose_start: pose_start + self.context_size]
         search_end = min(pose_start + self.context_size + self.search_window, pose.shape[0])
@@ -225,31 +282,27 @@ class CityWalkDataset(Dataset):
         target_position = target_pose[:3]
         transformed_input_positions = (input_positions - target_position)[:, [0, 2]]
         if self.mode == 'train':
-            rand_angle = np.random.uniform(-np.pi, np.pi)
+            rand_angle = (2 * self._random.uniform() - 1) * np.pi
             rot_matrix = np.array([[np.cos(rand_angle), -np.sin(rand_angle)], [np.sin(rand_angle), np.cos(rand_angle)]])
             transformed_input_positions = transformed_input_positions @ rot_matrix.T
         return transformed_input_positions
     
-    def select_target_pose(self, future_poses):
-        arrived = np.random.rand() < self.arrived_prob
+    def select_target_index(self, future_poses):
+        arrived = self._random.uniform() < self.arrived_prob
         if arrived:
-            target_idx = random.randint(self.wp_length, self.wp_length + self.arrived_threshold)
+            low, high = self.wp_length, self.wp_length + self.arrived_threshold
         else:
-            target_idx = random.randint(self.wp_length + self.arrived_threshold, future_poses.shape[0] - 1)
-        target_pose = future_poses[target_idx]
-        return target_pose, arrived
+            low, high = self.wp_length + self.arrived_threshold, future_poses.shape[0] - 1
+        if high < low:
+            raise ValueError(f"Empty target index range [{low}, {high}]")
+        target_idx = low + int(self._random.uniform() * (high - low + 1))
+        return target_idx, arrived
 
     # def determine_arrived_label(self, current_pos, target_pos):
     #     distance_to_goal = np.linalg.norm(target_pos - current_pos, axis=0)
     #     arrived = distance_to_goal <= self.arrived_threshold
     #     return arrived
 
-    def extract_waypoints(self, pose, pose_start):
-        waypoint_start = pose_start + self.context_size
-        waypoint_end = waypoint_start + self.wp_length
-        waypoint_poses = pose[waypoint_start: waypoint_end]
-        return waypoint_poses
-
     # def add_noise(self, input_poses):
     #     noise = np.random.normal(0, self.input_noise, input_poses[:, :3].shape)
     #     scale = np.linalg.norm(input_poses[-1, :3] - input_poses[-2, :3])
@@ -257,7 +310,8 @@ class CityWalkDataset(Dataset):
     #     return input_poses
 
     def process_frames(self, frames):
-        frames = torch.tensor(frames).permute(0, 3, 1, 2).float() / 255.0  # Corrected normalization
+        # Frames stay uint8 (N, 3, H, W); normalization to [0, 1] happens on the GPU
+        frames = frames.permute(0, 3, 1, 2).contiguous()
         # Desired resolution
         desired_height = 360
         desired_width = 640
@@ -291,36 +345,3 @@ class CityWalkDataset(Dataset):
             frames = TF.center_crop(frames, (desired_height, desired_width))
         
         return frames
-
-    def transform_waypoints(self, waypoint_poses, current_pose_array):
-        current_pose_matrix = self.pose_to_matrix(current_pose_array)
-        current_pose_inv = np.linalg.inv(current_pose_matrix)
-        waypoint_matrices = self.poses_to_matrices(waypoint_poses)
-        transformed_waypoint_matrices = np.matmul(current_pose_inv[np.newaxis, :, :], waypoint_matrices)
-        waypoints_positions = transformed_waypoint_matrices[:, :3, 3]
-        return waypoints_positions
-
-    def transform_target_pose(self, target_pose, current_pose_array):
-        current_pose_matrix = self.pose_to_matrix(current_pose_array)
-        current_pose_inv = np.linalg.inv(current_pose_matrix)
-        target_pose_matrix = self.pose_to_matrix(target_pose)
-        transformed_target_matrix = np.matmul(current_pose_inv, target_pose_matrix)
-        target_position = transformed_target_matrix[:3, 3]
-        return target_position
-
-    def pose_to_matrix(self, pose):
-        position = pose[:3]
-        rotation = R.from_quat(pose[3:])
-        matrix = np.eye(4)
-        matrix[:3, :3] = rotation.as_matrix()
-        matrix[:3, 3] = position
-        return matrix
-
-    def poses_to_matrices(self, poses):
-        positions = poses[:, :3]
-        quats = poses[:, 3:]
-        rotations = R.from_quat(quats)
-        matrices = np.tile(np.eye(4), (poses.shape[0], 1, 1))
-        matrices[:, :3, :3] = rotations.as_matrix()
-        matrices[:, :3, 3] = positions
-        return matrices
@@ -5,8 +5,9 @@ from torch.utils.data import Dataset, Sampler
 import torchvision.transforms.functional as TF
 from decord import VideoReader, cpu
 from tqdm import tqdm
-from scipy.spatial.transform import Rotation as R
 import random
+from data.data_utils import RandomPool
+from data._pose_kernels import transform_all
 
 class CityWalkSampler(Sampler):
     def __init__(self, dataset):
@@ -52,7 +53,6 @@ class CityWalkFeatDataset(Dataset):
             for f in sorted(os.listdir(self.pose_dir))
             if f.endswith('.txt')
         ]
-        print(len(self.pose_path))
         if mode == 'train':
             self.pose_path = self.pose_path[:cfg.data.num_train]
         elif mode == 'val':
@@ -110,6 +110,14 @@ class CityWalkFeatDataset(Dataset):
 
         # Initialize the video reader cache per worker
         self.video_reader_cache = {'video_idx': None, 'video_reader': None}
+        # Per-worker random numbers, seeded in worker_init_fn
+        self._random = RandomPool()
+        # Output buffers of the pose kernel, rows are the input positions followed by the target
+        self._positions_xz = np.empty((self.context_size + 1, 2), dtype=np.float32)
+        self._waypoints_xz = np.empty((self.wp_length, 2), dtype=np.float32)
+        # Compile the pose kernel up front on real poses, so numba specializes for the runtime array type
+        transform_all(self.poses[0], self.context_size, self.context_size, self.wp_length, 0,
+                      self._positions_xz[:self.context_size], self._waypoints_xz, self._positions_xz[self.context_size:])
 
     def __len__(self):
         return len(self.lut)
@@ -120,7 +128,7 @@ class CityWalkFeatDataset(Dataset):
         # Retrieve or create the VideoReader for the current video
         if self.video_reader_cache['video_idx'] != video_idx:
             # Replace the old VideoReader with the new one
-            self.video_reader_cache['video_reader'] = VideoReader(self.video_path[video_idx], ctx=cpu(0))
+            self.video_reader_cache['video_reader'] = VideoReader(self.video_path[video_idx], ctx=cpu(0), num_threads=1)
             self.video_reader_cache['video_idx'] = video_idx
         video_reader = self.video_reader_cache['video_reader']
 
@@ -145,42 +153,32 @@ class CityWalkFeatDataset(Dataset):
 
         # Get input and future poses
         input_poses, future_poses = self.get_input_and_future_poses(pose, pose_start)
-        original_input_poses = np.copy(input_poses)  # Store original poses before noise
 
         # Select target pose
-        target_pose, arrived = self.select_target_pose(future_poses)
+        target_idx, arrived = self.select_target_index(future_poses)
 
         # Determine arrived label
         # arrived = self.determine_arrived_label(input_poses[-1, :3], target_pose[:3])
 
-        # Extract waypoints
-        waypoint_poses = self.extract_waypoints(pose, pose_start)
-
-        # # Add noise if necessary
-        # if self.input_noise > 0:
-        #     input_poses = self.add_noise(input_poses)
-
-        # Transform poses
-        current_pose = input_poses[-1]
+        # Transform input, waypoint and target positions into the current pose frame (X and Z only)
+        transform_all(pose[pose_start:], self.context_size, self.context_size, self.wp_length, target_idx,
+                      self._positions_xz[:self.context_size], self._waypoints_xz, self._positions_xz[self.context_size:])
         if self.cfg.model.cord_embedding.type == 'polar':
-            transformed_input_positions = self.input2target(input_poses, target_pose)
+            transformed_input_positions = self.input2target(input_poses, future_poses[target_idx])
         elif self.cfg.model.cord_embedding.type == 'input_target':
-            transformed_input_positions = np.concatenate([
-                self.transform_poses(input_poses, current_pose)[:, [0, 2]], 
-                self.transform_target_pose(target_pose, current_pose)[np.newaxis, [0, 2]]
-            ], axis=0)
+            transformed_input_positions = self._positions_xz
         else:
             raise NotImplementedError(f"Coordinate embedding type {self.cfg.model.cord_embedding} not implemented")
-        waypoints_transformed = self.transform_waypoints(waypoint_poses, current_pose)
 
         # Convert data to tensors
         input_positions = torch.tensor(transformed_input_positions, dtype=torch.float32)
-        waypoints_transformed = torch.tensor(waypoints_transformed[:, [0, 2]], dtype=torch.float32)
+        waypoints_transformed = torch.tensor(self._waypoints_xz, dtype=torch.float32)
         step_scale = torch.tensor(self.step_scale[video_idx], dtype=torch.float32)
         step_scale = torch.clamp(step_scale, min=1e-2)
         input_positions_scaled = input_positions / step_scale
         waypoints_scaled = waypoints_transformed / step_scale
-        input_positions_scaled[:self.context_size-1] += torch.randn(self.context_size-1, 2) * self.input_noise
+        if self.input_noise > 0:
+            self._random.add_noise_(input_positions_scaled[:self.context_size-1], self.input_noise)
         arrived = torch.tensor(arrived, dtype=torch.float32)
         sample = {
             'video_frames': input_frames,
@@ -193,28 +191,15 @@ class CityWalkFeatDataset(Dataset):
 
         # For visualization during validation
         if self.mode in ['val', 'test']:
-            # vis_input_positions = self.transform_poses(input_poses, current_pose)
-            transformed_original_input_positions = self.transform_poses(original_input_poses, current_pose)
-            target_transformed = self.transform_target_pose(target_pose, current_pose)
-
-            original_input_positions = torch.tensor(transformed_original_input_positions[:, [0, 2]], dtype=torch.float32)
-            # noisy_input_positions = torch.tensor(vis_input_positions[:, [0, 2]], dtype=torch.float32)
+            original_input_positions = torch.tensor(self._positions_xz[:self.context_size], dtype=torch.float32)
             noisy_input_positions = input_positions_scaled[:-1] * step_scale
-            target_transformed_position = torch.tensor(target_transformed[[0, 2]], dtype=torch.float32)  # Only X and Z
+            target_transformed_position = torch.tensor(self._positions_xz[self.context_size], dtype=torch.float32)  # Only X and Z
             sample['original_input_positions'] = original_input_positions
             sample['noisy_input_positions'] = noisy_input_positions
             sample['gt_waypoints'] = waypoints_transformed
             sample['target_transformed'] = target_transformed_position  # Add target coordinate
         return sample
 
-    def transform_poses(self, poses, current_pose_array):
-        current_pose_matrix = self.pose_to_matrix(current_pose_array)
-        current_pose_inv = np.linalg.inv(current_pose_matrix)
-        pose_matrices = self.poses_to_matrices(poses)
-        transformed_matrices = np.matmul(current_pose_inv[np.newaxis, :, :], pose_matrices)
-        positions = transformed_matrices[:, :3, 3]
-        return positions
-
     def get_input_and_future_poses(self, pose, pose_start):
         input_poses = pose[pose_start: pose_start + self.context_size]
         search_end = min(pose_start + self.context_size + self.search_window, pose.shape[0])
@@ -228,31 +213,27 @@ class CityWalkFeatDataset(Dataset):
         target_position = target_pose[:3]
         transformed_input_positions = (input_positions - target_position)[:, [0, 2]]
         if self.mode == 'train':
-            rand_angle = np.random.uniform(-np.pi, np.pi)
+            rand_angle = (2 * self._random.uniform() - 1) * np.pi
             rot_matrix = np.array([[np.cos(rand_angle), -np.sin(rand_angle)], [np.sin(rand_angle), np.cos(rand_angle)]])
             transformed_input_positions = transformed_input_positions @ rot_matrix.T
         return transformed_input_positions
     
-    def select_target_pose(self, future_poses):
-        arrived = np.random.rand() < self.arrived_prob
+    def select_target_index(self, future_poses):
+        arrived = self._random.uniform() < self.arrived_prob
         if arrived:
-            target_idx = random.randint(self.wp_length, self.wp_length + self.arrived_threshold)
+            low, high = self.wp_length, self.wp_length + self.arrived_threshold
         else:
-            target_idx = random.randint(self.wp_length + self.arrived_threshold, future_poses.shape[0] - 1)
-        target_pose = future_poses[target_idx]
-        return target_pose, arrived
+            low, high = self.wp_length + self.arrived_threshold, future_poses.shape[0] - 1
+        if high < low:
+            raise ValueError(f"Empty target index range [{low}, {high}]")
+        target_idx = low + int(self._random.uniform() * (high - low + 1))
+        return target_idx, arrived
 
     # def determine_arrived_label(self, current_pos, target_pos):
     #     distance_to_goal = np.linalg.norm(target_pos - current_pos, axis=0)
     #     arrived = distance_to_goal <= self.arrived_threshold
     #     return arrived
 
-    def extract_waypoints(self, pose, pose_start):
-        waypoint_start = pose_start + self.context_size
-        waypoint_end = waypoint_start + self.wp_length
-        waypoint_poses = pose[waypoint_start: waypoint_end]
-        return waypoint_poses
-
     # def add_noise(self, input_poses):
     #     noise = np.random.normal(0, self.input_noise, input_poses[:, :3].shape)
     #     scale = np.linalg.norm(input_poses[-1, :3] - input_poses[-2, :3])
@@ -294,36 +275,3 @@ class CityWalkFeatDataset(Dataset):
             frames = TF.center_crop(frames, (desired_height, desired_width))
         
         return frames
-
-    def transform_waypoints(self, waypoint_poses, current_pose_array):
-        current_pose_matrix = self.pose_to_matrix(current_pose_array)
-        current_pose_inv = np.linalg.inv(current_pose_matrix)
-        waypoint_matrices = self.poses_to_matrices(waypoint_poses)
-        transformed_waypoint_matrices = np.matmul(current_pose_inv[np.newaxis, :, :], waypoint_matrices)
-        waypoints_positions = transformed_waypoint_matrices[:, :3, 3]
-        return waypoints_positions
-
-    def transform_target_pose(self, target_pose, current_pose_array):
-        current_pose_matrix = self.pose_to_matrix(current_pose_array)
-        current_pose_inv = np.linalg.inv(current_pose_matrix)
-        target_pose_matrix = self.pose_to_matrix(target_pose)
-        transformed_target_matrix = np.matmul(current_pose_inv, target_pose_matrix)
-        target_position = transformed_target_matrix[:3, 3]
-        return target_position
-
-    def pose_to_matrix(self, pose):
-        position = pose[:3]
-        rotation = R.from_quat(pose[3:])
-        matrix = np.eye(4)
-        matrix[:3, :3] = rotation.as_matrix()
-        matrix[:3, 3] = position
-        return matrix
-
-    def poses_to_matrices(self, poses):
-        positions = poses[:, :3]
-        quats = poses[:, 3:]
-        rotations = R.from_quat(quats)
-        matrices = np.tile(np.eye(4), (poses.shape[0], 1, 1))
-        matrices[:, :3, :3] = rotations.as_matrix()
-        matrices[:, :3, 3] = positions
-        return matrices
@@ -0,0 +1,92 @@
+import os
+import warnings
+from contextlib import suppress
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from lightning_fabric.utilities.seed import pl_worker_init_function
+
+RAND_POOL_SIZE = 1 << 16
+
+class RandomPool:
+    """
+    Random numbers for the datasets, drawn from one numpy Generator per worker. Uniform [0, 1) draws
+    are served from a pre-sampled pool that is refilled whenever the cursor wraps, and input noise is
+    written into a reused buffer. The generator is seeded in worker_init_fn, or lazily from the torch
+    seed in the main process.
+    """
+    def __init__(self):
+        self.seed(None)
+
+    def seed(self, seed):
+        self._rng = None if seed is None else np.random.default_rng(seed)
+        # Force the pool to be refilled from the new generator
+        self._pool = None
+        self._cursor = 0
+        self._noise_buf = None
+
+    @property
+    def rng(self):
+        if self._rng is None:
+            self._rng = np.random.default_rng(torch.initial_seed())
+        return self._rng
+
+    def uniform(self):
+        if self._cursor == 0:
+            self._pool = self.rng.random(RAND_POOL_SIZE)
+        u = self._pool[self._cursor]
+        self._cursor = (self._cursor + 1) % RAND_POOL_SIZE
+        return float(u)
+
+    def add_noise_(self, positions, std):
+        """
+        Add Gaussian noise with standard deviation std to a float32 CPU tensor in place.
+        """
+        if self._noise_buf is None or self._noise_buf.shape != tuple(positions.shape):
+            self._noise_buf = np.empty(tuple(positions.shape), dtype=np.float32)
+        self.rng.standard_normal(dtype=np.float32, out=self._noise_buf)
+        self._noise_buf *= std
+        positions += torch.from_numpy(self._noise_buf)
+
+def worker_init_fn(worker_id):
+    """
+    Seed each DataLoader worker the way Lightning does for seed_everything(workers=True), which it skips
+    for loaders with a custom worker_init_fn, then give the dataset its own numpy Generator from that
+    seed. Workers are kept single-threaded so num_workers processes do not oversubscribe the CPUs.
+    """
+    # Rank-aware seeds for torch, random and np.random, so streams differ across workers and DDP ranks
+    pl_worker_init_function(worker_id)
+    torch.set_num_threads(1)
+    try:
+        import cv2
+        cv2.setNumThreads(0)
+    except ImportError:
+        pass
+
+    worker_info = get_worker_info()
+    worker_info.dataset._random.seed(torch.initial_seed())
+
+def loader_kwargs(num_workers):
+    """
+    DataLoader arguments shared by all datamodules: seeded single-threaded workers that persist across
+    epochs with a deeper prefetch queue, and pinned batches for asynchronous host-to-device copies.
+    """
+    return dict(num_workers=num_workers, worker_init_fn=worker_init_fn, pin_memory=True,
+                persistent_workers=num_workers > 0, prefetch_factor=4 if num_workers > 0 else None)
+
+def write_cache(cache_path, write_fn):
+    """
+    Write a cache file through write_fn(file), via a temporary file so concurrent readers never
+    see a partial cache. Returns False instead of raising when the directory is not writable.
+    """
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            write_fn(tmp_file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        with suppress(OSError):
+            os.remove(tmp_path)
+        warnings.warn(f"Could not write cache files to {os.path.dirname(cache_path)}, data is parsed on every run")
+        return False
+    return True
@@ -2,11 +2,12 @@ import os
 import numpy as np
 import torch
 from torch.utils.data import Dataset
-import torchvision.transforms.functional as TF
 from tqdm import tqdm
 from scipy.spatial.transform import Rotation as R
-import random
-from PIL import Image
+from data.data_utils import RandomPool, write_cache
+from torchvision.io import decode_jpeg, read_file, ImageReadMode
+
+R_EARTH = 6378137  # Earth's radius in meters
 
 class TeleopDataset(Dataset):
     def __init__(self, cfg, mode):
@@ -57,7 +58,7 @@ class TeleopDataset(Dataset):
         # Initialize storage
         self.gps_positions = []
         self.poses = []
-        self.image_names = []
+        self.frame_ids = []
         self.count = []
         self.image_folders = []
         self.categories = []
@@ -69,73 +70,21 @@ class TeleopDataset(Dataset):
                 raise FileNotFoundError(f"Image folder {image_folder} does not exist.")
             self.image_folders.append(image_folder)
 
-            with open(f, 'r') as file:
-                lines = file.readlines()
-
-            gps_positions = []
-            poses = []
-            images = []
-            categories = []
-
-            # Reference GPS point for local coordinate conversion
-            ref_lat, ref_lon, ref_alt = None, None, None
-
-            for i in range(0, len(lines), 3):
-                gps_line = lines[i].strip()
-                pose_line = lines[i+1].strip()
-                category_line = lines[i+2].strip()
-
-                # Parse GPS data
-                gps_tokens = gps_line.split(',')
-                latitude = float(gps_tokens[1])
-                longitude = float(gps_tokens[2])
-                # accuracy = float(gps_tokens[3])
-                altitude = float(gps_tokens[4])
-
-                if ref_lat is None:
-                    ref_lat = latitude
-                    ref_lon = longitude
-                    ref_alt = altitude
-
-                # Convert GPS to local ENU coordinates
-                x, y = self.latlon_to_local(latitude, longitude, ref_lat, ref_lon)
-                z = altitude - ref_alt
-                gps_position = np.array([x, y, z])
-                gps_positions.append(gps_position)
-
-                # Parse pose data
-                pose_tokens = pose_line.split(',')
-                tx = float(pose_tokens[1])
-                ty = float(pose_tokens[2])
-                tz = float(pose_tokens[3])
-                rx = float(pose_tokens[4])
-                ry = float(pose_tokens[5])
-                rz = float(pose_tokens[6])
-                image_name = f"forward_{int(pose_tokens[7]):04d}.jpg"
-                pose = [tx, ty, tz, rx, ry, rz]
-                poses.append(pose)
-                images.append(image_name)
-
-                # Parse category
-                categories.append(category_line.split(','))
-
-            gps_positions = np.array(gps_positions)
-            poses = np.array(poses)
+            gps_positions, poses, frame_ids, categories = self._load_sequence(f)
             if poses.shape[0] == 0 or gps_positions.shape[0] == 0:
                 continue
             usable = poses.shape[0] - self.context_size - max(self.arrived_threshold*2, self.wp_length)
-            categories = np.array(categories, dtype=np.int32)
             print(f"Sequence {seq_idx}: {usable} usable samples.")
             self.count.append(max(usable, 0))
             self.gps_positions.append(gps_positions)
             self.poses.append(poses)
-            self.image_names.append(images)
+            self.frame_ids.append(frame_ids)
             self.categories.append(categories)
 
         valid_indices = [i for i, c in enumerate(self.count) if c > 0]
         self.gps_positions = [self.gps_positions[i] for i in valid_indices]
         self.poses = [self.poses[i] for i in valid_indices]
-        self.image_names = [self.image_names[i] for i in valid_indices]
+        self.frame_ids = [self.frame_ids[i] for i in valid_indices]
         self.image_folders = [self.image_folders[i] for i in valid_indices]
         self.count = [self.count[i] for i in valid_indices]
         self.step_scale = []
@@ -143,28 +92,101 @@ class TeleopDataset(Dataset):
             step_scale = np.linalg.norm(np.diff(pose[:, [0, 1]], axis=0), axis=1).mean()
             self.step_scale.append(step_scale)
 
-        self.lut = []
-        self.sequence_ranges = []
-        idx_counter = 0
-        for seq_idx, count in enumerate(self.count):
-            start_idx = idx_counter
-            interval = self.context_size if self.mode == 'train' else 1
-            # interval = 10
-            for pose_start in range(0, count, interval):
-                self.lut.append((seq_idx, pose_start))
-                idx_counter += 1
-            end_idx = idx_counter
-            self.sequence_ranges.append((start_idx, end_idx))
-        assert len(self.lut) > 0, "No usable samples found."
+        # Build the look-up table as two int32 arrays (sequence index, pose start) and sequence_ranges
+        interval = self.context_size if self.mode == 'train' else 1
+        # interval = 10
+        samples_per_sequence = np.array([(count + interval - 1) // interval for count in self.count], dtype=np.int64)
+        self.lut_sequence = np.repeat(np.arange(len(self.count), dtype=np.int32), samples_per_sequence)
+        self.lut_pose = np.concatenate(
+            [np.arange(0, count, interval, dtype=np.int32) for count in self.count] + [np.empty(0, dtype=np.int32)])
+        end_indices = np.cumsum(samples_per_sequence)
+        self.sequence_ranges = list(zip((end_indices - samples_per_sequence).tolist(), end_indices.tolist()))
+        assert len(self.lut_sequence) > 0, "No usable samples found."
+
+        # Per-worker random numbers, seeded in worker_init_fn
+        self._random = RandomPool()
 
     def __len__(self):
-        return len(self.lut)
+        return len(self.lut_sequence)
+
+    def _load_sequence(self, f):
+        """
+        Load the GPS positions, poses, image frame ids and categories of one sequence.
+        The parsed arrays are cached next to the pose file as .npz so later runs skip the text parsing.
+        """
+        cache_path = f.replace('.txt', '.npz')
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(f):
+            with np.load(cache_path) as data:
+                # Only use a cache whose poses are float32, as written below
+                if data['poses'].dtype == np.float32:
+                    return data['gps'], data['poses'], data['frame_ids'], data['categories']
+
+        gps_positions, poses, frame_ids, categories = self._parse_sequence(f)
+        # Without write access to the pose directory the sequence is simply parsed again next run
+        write_cache(cache_path, lambda cache_file: np.savez(
+            cache_file, gps=gps_positions, poses=poses, frame_ids=frame_ids, categories=categories))
+        return gps_positions, poses, frame_ids, categories
+
+    def _parse_sequence(self, f):
+        with open(f, 'r') as file:
+            lines = file.readlines()
+
+        latitudes = []
+        longitudes = []
+        altitudes = []
+        poses = []
+        frame_ids = []
+        categories = []
+
+        for i in range(0, len(lines), 3):
+            gps_line = lines[i].strip()
+            pose_line = lines[i+1].strip()
+            category_line = lines[i+2].strip()
+
+            # Parse GPS data
+            gps_tokens = gps_line.split(',')
+            latitudes.append(float(gps_tokens[1]))
+            longitudes.append(float(gps_tokens[2]))
+            # accuracy = float(gps_tokens[3])
+            altitudes.append(float(gps_tokens[4]))
+
+            # Parse pose data
+            pose_tokens = pose_line.split(',')
+            tx = float(pose_tokens[1])
+            ty = float(pose_tokens[2])
+            tz = float(pose_tokens[3])
+            rx = float(pose_tokens[4])
+            ry = float(pose_tokens[5])
+            rz = float(pose_tokens[6])
+            pose = [tx, ty, tz, rx, ry, rz]
+            poses.append(pose)
+            frame_ids.append(int(pose_tokens[7]))
+
+            # Parse category
+            categories.append(category_line.split(','))
+
+        # Convert GPS to local ENU coordinates, using the first fix as reference
+        if len(latitudes) > 0:
+            lat_rad = np.radians(latitudes)
+            lon_rad = np.radians(longitudes)
+            altitudes = np.asarray(altitudes)
+            x = (lon_rad - lon_rad[0]) * np.cos((lat_rad + lat_rad[0]) / 2) * R_EARTH
+            y = (lat_rad - lat_rad[0]) * R_EARTH
+            z = altitudes - altitudes[0]
+            gps_positions = np.stack([x, y, z], axis=1).astype(np.float32)
+        else:
+            gps_positions = np.empty((0, 3), dtype=np.float32)
+        poses = np.array(poses, dtype=np.float32)
+        frame_ids = np.array(frame_ids, dtype=np.int32)
+        categories = np.array(categories, dtype=np.int32)
+        return gps_positions, poses, frame_ids, categories
 
     def __getitem__(self, index):
-        sequence_idx, pose_start = self.lut[index]
+        sequence_idx = int(self.lut_sequence[index])
+        pose_start = int(self.lut_pose[index])
         gps_positions = self.gps_positions[sequence_idx]
         poses = self.poses[sequence_idx]
-        images = self.image_names[sequence_idx]
+        frame_ids = self.frame_ids[sequence_idx]
         image_folder = self.image_folders[sequence_idx]
 
         # Get input GPS positions
@@ -184,21 +206,24 @@ class TeleopDataset(Dataset):
         waypoint_end = waypoint_start + self.wp_length
         gt_waypoint_poses = poses[waypoint_start: waypoint_end]
 
-        # Transform waypoints to the coordinate frame of the current pose
-        current_pose = input_poses[-1]
-        history_positions = self.transform_poses(input_poses, current_pose)
-        gt_waypoints = self.transform_poses(gt_waypoint_poses, current_pose)
-
         # Select target pose for visualization
         target_pose = poses[pose_start + self.context_size + target_idx]
-        target_transformed = self.transform_pose(target_pose, current_pose)
+
+        # Transform history, waypoints and target to the coordinate frame of the current pose in one pass
+        current_pose = input_poses[-1]
+        positions = self.transform_positions(
+            np.concatenate([input_poses[:, :3], gt_waypoint_poses[:, :3], target_pose[np.newaxis, :3]], axis=0),
+            current_pose)
+        history_positions = positions[:self.context_size]
+        gt_waypoints = positions[self.context_size:-1]
+        target_transformed = positions[-1]
 
         # Transform input GPS positions by subtracting target waypoint position
         if self.cfg.model.cord_embedding.type == 'polar':
             input_positions = self.input2target(input_gps_positions, target_transformed[:2])
             # Apply random rotation if in training mode
             if self.mode == 'train':
-                rand_angle = np.random.uniform(-np.pi, np.pi)
+                rand_angle = (2 * self._random.uniform() - 1) * np.pi
                 rot_matrix = np.array([[np.cos(rand_angle), -np.sin(rand_angle)],
                                        [np.sin(rand_angle), np.cos(rand_angle)]])
                 input_positions = input_positions @ rot_matrix.T
@@ -212,7 +237,7 @@ class TeleopDataset(Dataset):
         arrived = torch.tensor(arrived, dtype=torch.float32)
 
         # Load frames
-        input_image_names = images[pose_start: pose_start + self.context_size]
+        input_image_names = [f"forward_{frame_id:04d}.jpg" for frame_id in frame_ids[pose_start: pose_start + self.context_size]]
         frames = self.load_frames(image_folder, input_image_names)
 
         # Convert to tensors
@@ -277,77 +302,35 @@ class TeleopDataset(Dataset):
         return rotated_input
 
     def select_target_index(self, future_positions):
-        arrived = np.random.rand() < self.arrived_prob
+        arrived = self._random.uniform() < self.arrived_prob
         max_idx = future_positions.shape[0] - 1
         if arrived:
-            target_idx = random.randint(self.wp_length, min(self.wp_length + self.arrived_threshold, max_idx))
+            low, high = self.wp_length, min(self.wp_length + self.arrived_threshold, max_idx)
         else:
-            target_idx = random.randint(self.wp_length + self.arrived_threshold, max_idx)
+            low, high = self.wp_length + self.arrived_threshold, max_idx
+        if high < low:
+            raise ValueError(f"Empty target index range [{low}, {high}]")
+        target_idx = low + int(self._random.uniform() * (high - low + 1))
         return target_idx, arrived
 
-    def transform_poses(self, poses, current_pose_array):
-        current_pose_matrix = self.pose_to_matrix(current_pose_array)
-        current_pose_inv = np.linalg.inv(current_pose_matrix)
-        pose_matrices = self.poses_to_matrices(poses)
-        transformed_matrices = np.matmul(current_pose_inv[np.newaxis, :, :], pose_matrices)
-        positions = transformed_matrices[:, :3, 3]
+    def transform_positions(self, positions, current_pose_array):
+        # The translation of inv(M_cur) @ M_i is R_cur^T (t_i - t_cur), so only the
+        # rotation of the current pose has to be converted
+        rot_cur = R.from_rotvec(current_pose_array[3:6]).as_matrix()
+        positions = (positions - current_pose_array[:3]) @ rot_cur
         # Handel lidar extrinsic
         positions[:, [0, 1]] = positions[:, [1, 0]]
         positions[:, 1] *= -1
         return positions
 
-    def transform_pose(self, pose, current_pose_array):
-        current_pose_matrix = self.pose_to_matrix(current_pose_array)
-        current_pose_inv = np.linalg.inv(current_pose_matrix)
-        pose_matrix = self.pose_to_matrix(pose)
-        transformed_matrix = np.matmul(current_pose_inv, pose_matrix)
-        position = transformed_matrix[:3, 3]
-        # Handel lidar extrinsic
-        position[[0, 1]] = position[[1, 0]]
-        position[1] *= -1
-        return position
-
-    def pose_to_matrix(self, pose):
-        tx, ty, tz, rx, ry, rz = pose
-        rotation = R.from_rotvec([rx, ry, rz])
-        matrix = np.eye(4)
-        matrix[:3, :3] = rotation.as_matrix()
-        matrix[:3, 3] = [tx, ty, tz]
-        return matrix
-
-    def poses_to_matrices(self, poses):
-        tx = poses[:, 0]
-        ty = poses[:, 1]
-        tz = poses[:, 2]
-        rx = poses[:, 3]
-        ry = poses[:, 4]
-        rz = poses[:, 5]
-        rotations = R.from_rotvec(np.stack([rx, ry, rz], axis=1))
-        matrices = np.tile(np.eye(4), (poses.shape[0], 1, 1))
-        matrices[:, :3, :3] = rotations.as_matrix()
-        matrices[:, :3, 3] = np.stack([tx, ty, tz], axis=1)
-        return matrices
-
     def load_frames(self, image_folder, image_names):
-        frames = []
+        encoded = []
         for image_name in image_names:
             image_path = os.path.join(image_folder, image_name)
             if not os.path.exists(image_path):
                 raise FileNotFoundError(f"Image {image_path} does not exist.")
-            image = Image.open(image_path).convert('RGB')
-            image = TF.to_tensor(image)
-            frames.append(image)
+            encoded.append(read_file(image_path))
+        # Decode all frames in one libjpeg-turbo call, kept uint8 (3, H, W); normalization happens on the GPU
+        frames = decode_jpeg(encoded, mode=ImageReadMode.RGB)
         frames = torch.stack(frames)
         return frames
-
-    def latlon_to_local(self, lat, lon, lat0, lon0):
-        R_earth = 6378137  # Earth's radius in meters
-        lat_rad = np.radians(lat)
-        lon_rad = np.radians(lon)
-        lat0_rad = np.radians(lat0)
-        lon0_rad = np.radians(lon0)
-        dlat = lat_rad - lat0_rad
-        dlon = lon_rad - lon0_rad
-        x = dlon * np.cos((lat_rad + lat0_rad) / 2) * R_earth
-        y = dlat * R_earth
-        return x, y
@@ -8,9 +8,10 @@ from pl_modules.citywalk_datamodule import CityWalkDataModule
 from pl_modules.teleop_datamodule import TeleopDataModule
 from pl_modules.citywalker_module import CityWalkerModule
 from pl_modules.citywalker_feat_module import CityWalkerFeatModule
+from pl_modules.pl_utils import amp_precision
 import torch
 
-torch.set_float32_matmul_precision('medium')
+torch.set_float32_matmul_precision('high')
 pl.seed_everything(42, workers=True)
 
 
@@ -67,6 +68,8 @@ def main():
         raise ValueError(f"Invalid model: {cfg.model.type}")
     print(f"Loaded model from checkpoint: {args.checkpoint}")
     print(pl.utilities.model_summary.ModelSummary(model, max_depth=2))
+    if getattr(cfg.training, 'compile', False):
+        model = torch.compile(model, mode='reduce-overhead')
 
     # Initialize logger
     logger = None  # Default to no logger
@@ -96,14 +99,17 @@ def main():
 
     num_gpu = 1
 
+    precision = amp_precision(cfg.training.amp)
+
     # Set up Trainer
     trainer = pl.Trainer(
         default_root_dir=result_dir,
         max_epochs=cfg.training.max_epochs,
         logger=logger,  # Pass the logger (WandbLogger or None)
         devices=num_gpu,
-        precision='16-mixed' if cfg.training.amp else 32,
+        precision=precision,
         accelerator='gpu' if num_gpu > 0 else 'cpu',
+        gradient_clip_val=getattr(cfg.training, 'grad_clip', None),
         callbacks=[
             checkpoint_callback,
             pl.callbacks.TQDMProgressBar(refresh_rate=cfg.logging.pbar_rate),
@@ -3,8 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms.functional as TF
 import torchvision.transforms as transforms
-from efficientnet_pytorch import EfficientNet
-from model.model_utils import PolarEmbedding, MultiLayerDecoder, PositionalEncoding
+from model.model_utils import PolarEmbedding, MultiLayerDecoder, PositionalEncoding, merge_output_heads_hook, trajectory_cumsum
 from torchvision import models
 
 class CityWalker(nn.Module):
@@ -19,6 +18,8 @@ class CityWalker(nn.Module):
         self.do_rgb_normalize = cfg.model.do_rgb_normalize
         self.do_resize = cfg.model.do_resize
         self.output_coordinate_repr = cfg.model.output_coordinate_repr  # 'polar' or 'euclidean'
+        # Lower-triangular ones: cumsum_mat @ deltas is the cumulative sum over the trajectory as one small GEMM
+        self.register_buffer('cumsum_mat', torch.tril(torch.ones(self.len_traj_pred, self.len_traj_pred)), persistent=False)
 
         # if self.obs_encoder_type.startswith("dinov2"):
         self.crop = cfg.model.obs_encoder.crop
@@ -27,6 +28,9 @@ class CityWalker(nn.Module):
         if self.do_rgb_normalize:
             self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
             self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+            # Normalization folded into one affine op, obs * inv_std + neg_mean_inv_std (not saved in checkpoints)
+            self.register_buffer('inv_std', 1.0 / self.std, persistent=False)
+            self.register_buffer('neg_mean_inv_std', -self.mean / self.std, persistent=False)
 
         # Observation Encoder
         if self.obs_encoder_type.startswith("efficientnet"):
@@ -34,16 +38,19 @@ class CityWalker(nn.Module):
             self.obs_encoder = model_constructor(weights="DEFAULT")
             self.num_obs_features = self.obs_encoder.classifier[1].in_features
             self.obs_encoder.classifier = nn.Identity()  # Remove classification layer
+            self._encode_obs = self._encode_efficientnet
         elif self.obs_encoder_type.startswith("resnet"):
             model_constructor = getattr(models, self.obs_encoder_type)
             self.obs_encoder = model_constructor(weights="DEFAULT")
             self.num_obs_features = self.obs_encoder.fc.in_features
             self.obs_encoder.fc = nn.Identity()  # Remove classification layer
+            self._encode_obs = self._encode_resnet
         elif self.obs_encoder_type.startswith("vit"):
             model_constructor = getattr(models, self.obs_encoder_type)
             self.obs_encoder = model_constructor(weights="IMAGENET1K_SWAG_E2E_V1")
             self.num_obs_features = self.obs_encoder.hidden_dim
             self.obs_encoder.heads = nn.Identity()  # Remove classification head
+            self._encode_obs = self._encode_transformer
         elif self.obs_encoder_type.startswith("dinov2"):
             self.obs_encoder = torch.hub.load('facebookresearch/dinov2', self.obs_encoder_type)
             feature_dim = {
@@ -56,9 +63,15 @@ class CityWalker(nn.Module):
                 for param in self.obs_encoder.parameters():
                     param.requires_grad = False
             self.num_obs_features = feature_dim[self.obs_encoder_type]
+            self._encode_obs = self._encode_transformer
         else:
             raise NotImplementedError(f"Observation encoder type {self.obs_encoder_type} not implemented")
 
+        # CNN encoders run faster on NHWC tensors (cuDNN Tensor Core kernels)
+        self.use_channels_last = self.obs_encoder_type.startswith(("efficientnet", "resnet"))
+        if self.use_channels_last:
+            self.obs_encoder = self.obs_encoder.to(memory_format=torch.channels_last)
+
         # Coordinate Embedding
         if self.cord_embedding_type == 'polar':
             self.cord_embedding = PolarEmbedding(cfg)
@@ -93,8 +106,21 @@ class CityWalker(nn.Module):
                 num_layers=cfg.model.decoder.num_layers,
                 ff_dim_factor=cfg.model.decoder.ff_dim_factor,
             )
-            self.wp_predictor = nn.Linear(32, self.len_traj_pred * 2)
-            self.arrive_predictor = nn.Linear(32, 1)
+            # Waypoint and arrival predictions share one Linear: len_traj_pred * 2 waypoint outputs, then 1 arrival logit
+            self.head = nn.Linear(32, self.len_traj_pred * 2 + 1)
+            self._register_load_state_dict_pre_hook(merge_output_heads_hook)
+            # Regional compile: the decoder has fixed (B, context_size+1, embed_dim) inputs and compiles
+            # much faster than the whole model. compile() works in place, so state_dict keys are unchanged
+            if getattr(cfg.model.decoder, 'compile', False):
+                self.decoder.compile(mode="max-autotune-no-cudagraphs", dynamic=False)
+            # Output representation is fixed per model, so resolve its post-processing here instead of per forward
+            if self.output_coordinate_repr == 'euclidean':
+                self._attention_output = self._euclidean_output
+            elif self.output_coordinate_repr == 'polar':
+                self._attention_output = self._polar_output
+            else:
+                raise NotImplementedError(f"Output coordinate representation {self.output_coordinate_repr} not implemented")
+            self._decode = self._decode_attention
         elif cfg.model.decoder.type == "diff_policy":
             from diffusion_policy.model.diffusion.conditional_unet1d import ConditionalUnet1D
             from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
@@ -127,6 +153,7 @@ class CityWalker(nn.Module):
                 clip_sample=True,
                 prediction_type='epsilon'
             )
+            self._decode = self._decode_diff_policy
         else:
             raise NotImplementedError(f"Decoder type {cfg.model.decoder.type} not implemented")  
 
@@ -136,99 +163,109 @@ class CityWalker(nn.Module):
             obs: (B, N, 3, H, W) tensor
             cord: (B, N, 2) tensor
         """
-        B, N, _, H, W = obs.shape
-        obs = obs.view(B * N, 3, H, W)
+        B, N = obs.shape[:2]
+        obs = obs.flatten(0, 1)
         if self.do_rgb_normalize:
-            obs = (obs - self.mean) / self.std
+            obs = torch.addcmul(self.neg_mean_inv_std, obs, self.inv_std)
         if self.do_resize:
             obs = TF.center_crop(obs, self.crop)
             obs = TF.resize(obs, self.resize)
+        if self.use_channels_last:
+            obs = obs.contiguous(memory_format=torch.channels_last)
 
-        # Observation Encoding
-        if self.obs_encoder_type.startswith("efficientnet"):
-            obs_enc = self.obs_encoder(obs)
-        elif self.obs_encoder_type.startswith("resnet"):
-            x = self.obs_encoder.conv1(obs)
-            x = self.obs_encoder.bn1(x)
-            x = self.obs_encoder.relu(x)
-            x = self.obs_encoder.maxpool(x)
-            x = self.obs_encoder.layer1(x)
-            x = self.obs_encoder.layer2(x)
-            x = self.obs_encoder.layer3(x)
-            x = self.obs_encoder.layer4(x)
-            x = self.obs_encoder.avgpool(x)
-            obs_enc = torch.flatten(x, 1)
-        elif self.obs_encoder_type.startswith("vit"):
-            obs_enc = self.obs_encoder(obs)  # Returns class token embedding
-        elif self.obs_encoder_type.startswith("dinov2"):
-            obs_enc = self.obs_encoder(obs)
-        else:
-            raise NotImplementedError(f"Observation encoder type {self.obs_encoder_type} not implemented")
-
-        obs_enc = self.compress_obs_enc(obs_enc).view(B, N, -1)
+        # Observation Encoding, the encoder-specific method is bound in __init__
+        obs_enc = self._encode_obs(obs)
+        obs_enc = self.compress_obs_enc(obs_enc).unflatten(0, (B, N))
 
         # Coordinate Encoding
-        cord_enc = self.cord_embedding(cord).view(B, -1)
+        cord_enc = self.cord_embedding(cord).reshape(B, -1)
         cord_enc = self.compress_goal_enc(cord_enc).view(B, 1, -1)
 
         tokens = torch.cat([obs_enc, cord_enc], dim=1)
 
-        # Decoder
-        if self.decoder_type == "attention":
-            dec_out = self.decoder(tokens)
-            wp_pred = self.wp_predictor(dec_out).view(B, self.len_traj_pred, 2)
-            arrive_pred = self.arrive_predictor(dec_out).view(B, 1)
-            # Waypoint Prediction Processing
-            if self.output_coordinate_repr == 'euclidean':
-                # Predict deltas and compute cumulative sum
-                wp_pred = torch.cumsum(wp_pred, dim=1)
-                return wp_pred, arrive_pred
-            elif self.output_coordinate_repr == 'polar':
-                # Convert polar deltas to Cartesian deltas and compute cumulative sum
-                distances = wp_pred[:, :, 0]
-                angles = wp_pred[:, :, 1]
-                dx = distances * torch.cos(angles)
-                dy = distances * torch.sin(angles)
-                deltas = torch.stack([dx, dy], dim=-1)
-                wp_pred = torch.cumsum(deltas, dim=1)
-                return wp_pred, arrive_pred, distances, angles
-            else:
-                raise NotImplementedError(f"Output coordinate representation {self.output_coordinate_repr} not implemented")
-        elif self.decoder_type == "diff_policy":
-            tokens = self.positional_encoding(tokens)
-            dec_out = self.sa_decoder(tokens).mean(dim=1)
-            
-            deltas = torch.diff(gt_action, dim=1, prepend=torch.zeros_like(gt_action[:, :1, :]))
-            if self.output_coordinate_repr == 'polar':
-                distances = torch.norm(deltas, dim=-1)
-                angles = torch.atan2(deltas[:, :, 1], deltas[:, :, 0])
-                deltas = torch.stack([distances, angles], dim=-1)
-            elif self.output_coordinate_repr == 'euclidean':
-                pass
-            else:
-                raise NotImplementedError(f"Output coordinate representation {self.output_coordinate_repr} not implemented")
-            noise = torch.randn_like(deltas)
-            timesteps = torch.randint(0, self.noise_scheduler.config.num_train_timesteps, (B,), device=noise.device).long()
-            noisy_action = self.noise_scheduler.add_noise(deltas, noise, timesteps)
-            
-            # Pad noisy_action with zeros to make the second dimension 12
-            # Refer to https://github.com/real-stanford/diffusion_policy/issues/32#issuecomment-1834622174
-            padding_size = 12 - noisy_action.size(1)
-            if padding_size > 0:
-                noisy_action_pad = F.pad(noisy_action, (0, 0, 0, padding_size))
-            
-            noise_pred = self.wp_predictor(sample=noisy_action_pad, timestep=timesteps, global_cond=dec_out)
-            noise_pred = noise_pred[:, :self.len_traj_pred]
-            alpha_cumprod = self.noise_scheduler.alphas_cumprod[timesteps].view(B, 1, 1)
-            wp_pred = (noisy_action - noise_pred * (1 - alpha_cumprod).sqrt()) / alpha_cumprod.sqrt()
-            if self.output_coordinate_repr == 'polar':
-                distances = wp_pred[:, :, 0]
-                angles = wp_pred[:, :, 1]
-                dx = distances * torch.cos(angles)
-                dy = distances * torch.sin(angles)
-                wp_pred = torch.stack([dx, dy], dim=-1)
-            wp_pred = torch.cumsum(wp_pred, dim=1)
-            
-            arrived_pres = self.arrive_predictor(dec_out).view(B, 1)
-            
-            return wp_pred, noise_pred, arrived_pres, noise
+        # Decoder, bound in __init__ according to the decoder type
+        return self._decode(tokens, gt_action)
+
+    def _encode_efficientnet(self, obs):
+        x = self.obs_encoder.features(obs)
+        return F.adaptive_avg_pool2d(x, 1).flatten(1)
+
+    def _encode_resnet(self, obs):
+        x = self.obs_encoder.conv1(obs)
+        x = self.obs_encoder.bn1(x)
+        x = self.obs_encoder.relu(x)
+        x = self.obs_encoder.maxpool(x)
+        x = self.obs_encoder.layer1(x)
+        x = self.obs_encoder.layer2(x)
+        x = self.obs_encoder.layer3(x)
+        x = self.obs_encoder.layer4(x)
+        x = self.obs_encoder.avgpool(x)
+        return torch.flatten(x, 1)
+
+    def _encode_transformer(self, obs):
+        # ViT returns the class token embedding, DINOv2 its normalized class token
+        return self.obs_encoder(obs)
+
+    def _decode_attention(self, tokens, gt_action=None):
+        B = tokens.shape[0]
+        dec_out = self.decoder(tokens)
+        head_out = self.head(dec_out)
+        wp_pred = head_out[:, :-1].view(B, self.len_traj_pred, 2)
+        arrive_pred = head_out[:, -1:]
+        # Waypoint Prediction Processing, bound in __init__ according to the output representation
+        return self._attention_output(wp_pred, arrive_pred)
+
+    def _euclidean_output(self, wp_pred, arrive_pred):
+        # Predict deltas and compute cumulative sum
+        wp_pred = trajectory_cumsum(self.cumsum_mat, wp_pred)
+        return wp_pred, arrive_pred
+
+    def _polar_output(self, wp_pred, arrive_pred):
+        # Convert polar deltas to Cartesian deltas and compute cumulative sum
+        distances = wp_pred[:, :, 0]
+        angles = wp_pred[:, :, 1]
+        dx = distances * torch.cos(angles)
+        dy = distances * torch.sin(angles)
+        deltas = torch.stack([dx, dy], dim=-1)
+        wp_pred = trajectory_cumsum(self.cumsum_mat, deltas)
+        return wp_pred, arrive_pred, distances, angles
+
+    def _decode_diff_policy(self, tokens, gt_action):
+        B = tokens.shape[0]
+        tokens = self.positional_encoding(tokens)
+        dec_out = self.sa_decoder(tokens).mean(dim=1)
+        
+        deltas = torch.diff(gt_action, dim=1, prepend=torch.zeros_like(gt_action[:, :1, :]))
+        if self.output_coordinate_repr == 'polar':
+            distances = torch.norm(deltas, dim=-1)
+            angles = torch.atan2(deltas[:, :, 1], deltas[:, :, 0])
+            deltas = torch.stack([distances, angles], dim=-1)
+        elif self.output_coordinate_repr == 'euclidean':
+            pass
+        else:
+            raise NotImplementedError(f"Output coordinate representation {self.output_coordinate_repr} not implemented")
+        noise = torch.randn_like(deltas)
+        timesteps = torch.randint(0, self.noise_scheduler.config.num_train_timesteps, (B,), device=noise.device).long()
+        noisy_action = self.noise_scheduler.add_noise(deltas, noise, timesteps)
+        
+        # Pad noisy_action with zeros to make the second dimension 12
+        # Refer to https://github.com/real-stanford/diffusion_policy/issues/32#issuecomment-1834622174
+        padding_size = 12 - noisy_action.size(1)
+        if padding_size > 0:
+            noisy_action_pad = F.pad(noisy_action, (0, 0, 0, padding_size))
+        
+        noise_pred = self.wp_predictor(sample=noisy_action_pad, timestep=timesteps, global_cond=dec_out)
+        noise_pred = noise_pred[:, :self.len_traj_pred]
+        alpha_cumprod = self.noise_scheduler.alphas_cumprod[timesteps].view(B, 1, 1)
+        wp_pred = (noisy_action - noise_pred * (1 - alpha_cumprod).sqrt()) / alpha_cumprod.sqrt()
+        if self.output_coordinate_repr == 'polar':
+            distances = wp_pred[:, :, 0]
+            angles = wp_pred[:, :, 1]
+            dx = distances * torch.cos(angles)
+            dy = distances * torch.sin(angles)
+            wp_pred = torch.stack([dx, dy], dim=-1)
+        wp_pred = trajectory_cumsum(self.cumsum_mat, wp_pred)
+        
+        arrived_pres = self.arrive_predictor(dec_out).view(B, 1)
+        
+        return wp_pred, noise_pred, arrived_pres, noise
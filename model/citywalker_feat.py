@@ -3,8 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms.functional as TF
 import torchvision.transforms as transforms
-from efficientnet_pytorch import EfficientNet
-from model.model_utils import PolarEmbedding, FeatPredictor, PositionalEncoding
+from model.model_utils import PolarEmbedding, FeatPredictor, PositionalEncoding, merge_output_heads_hook, trajectory_cumsum
 from torchvision import models
 
 class CityWalkerFeat(nn.Module):
@@ -18,6 +17,11 @@ class CityWalkerFeat(nn.Module):
         self.do_rgb_normalize = cfg.model.do_rgb_normalize
         self.do_resize = cfg.model.do_resize
         self.output_coordinate_repr = cfg.model.output_coordinate_repr  # 'polar' or 'euclidean'
+        # Only euclidean outputs are supported, checked once here rather than in every forward
+        if self.output_coordinate_repr != 'euclidean':
+            raise NotImplementedError(f"Output coordinate representation {self.output_coordinate_repr} not implemented")
+        # Lower-triangular ones: cumsum_mat @ deltas is the cumulative sum over the trajectory as one small GEMM
+        self.register_buffer('cumsum_mat', torch.tril(torch.ones(self.len_traj_pred, self.len_traj_pred)), persistent=False)
 
         # if self.obs_encoder_type.startswith("dinov2"):
         self.crop = cfg.model.obs_encoder.crop
@@ -26,6 +30,9 @@ class CityWalkerFeat(nn.Module):
         if self.do_rgb_normalize:
             self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
             self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+            # Normalization folded into one affine op, obs * inv_std + neg_mean_inv_std (not saved in checkpoints)
+            self.register_buffer('inv_std', 1.0 / self.std, persistent=False)
+            self.register_buffer('neg_mean_inv_std', -self.mean / self.std, persistent=False)
 
         # Observation Encoder
         if self.obs_encoder_type.startswith("dinov2"):
@@ -59,6 +66,9 @@ class CityWalkerFeat(nn.Module):
             num_layers=cfg.model.decoder.num_layers,
             ff_dim_factor=cfg.model.decoder.ff_dim_factor,
         )
+        # Regional compile of the transformer stack; compile() works in place, so state_dict keys are unchanged
+        if getattr(cfg.model.decoder, 'compile', False):
+            self.predictor.compile(mode="max-autotune-no-cudagraphs", dynamic=False)
         self.predictor_mlp = nn.Sequential(
             nn.Linear((self.context_size+1) * self.num_obs_features, 256),
             nn.ReLU(),
@@ -68,8 +78,9 @@ class CityWalkerFeat(nn.Module):
             nn.ReLU(),
             nn.Linear(64, 32)
         )
-        self.wp_predictor = nn.Linear(32, self.len_traj_pred * 2)
-        self.arrive_predictor = nn.Linear(32, 1)
+        # Waypoint and arrival predictions share one Linear: len_traj_pred * 2 waypoint outputs, then 1 arrival logit
+        self.head = nn.Linear(32, self.len_traj_pred * 2 + 1)
+        self._register_load_state_dict_pre_hook(merge_output_heads_hook)
 
     def forward(self, obs, cord, future_obs=None):
         """
@@ -77,29 +88,29 @@ class CityWalkerFeat(nn.Module):
             obs: (B, N, 3, H, W) tensor
             cord: (B, N, 2) tensor
         """
-        B, N, _, H, W = obs.shape
-        obs = obs.view(B * N, 3, H, W)
+        B, N = obs.shape[:2]
+        obs = obs.flatten(0, 1)
         if future_obs is not None:
-            future_obs = future_obs.view(B * N, 3, H, W)
+            future_obs = future_obs.flatten(0, 1)
         if self.do_rgb_normalize:
-            obs = (obs - self.mean) / self.std
+            obs = torch.addcmul(self.neg_mean_inv_std, obs, self.inv_std)
             if future_obs is not None:
-                future_obs = (future_obs - self.mean) / self.std
+                future_obs = torch.addcmul(self.neg_mean_inv_std, future_obs, self.inv_std)
         if self.do_resize:
-            obs = TF.center_crop(obs, self. crop)
+            obs = TF.center_crop(obs, self.crop)
             obs = TF.resize(obs, self.resize)
             if future_obs is not None:
                 future_obs = TF.center_crop(future_obs, self.crop)
                 future_obs = TF.resize(future_obs, self.resize)
 
-        obs_enc = self.obs_encoder(obs).view(B, N, -1)
+        obs_enc = self.obs_encoder(obs).unflatten(0, (B, N))
         if future_obs is not None:
-            future_obs_enc = self.obs_encoder(future_obs).view(B, N, -1)
+            future_obs_enc = self.obs_encoder(future_obs).unflatten(0, (B, N))
         else:
             future_obs_enc = None
 
         # Coordinate Encoding
-        cord_enc = self.cord_embedding(cord).view(B, -1)
+        cord_enc = self.cord_embedding(cord).reshape(B, -1)
         cord_enc = self.compress_goal_enc(cord_enc).view(B, 1, -1)
 
         tokens = torch.cat([obs_enc, cord_enc], dim=1)
@@ -107,12 +118,9 @@ class CityWalkerFeat(nn.Module):
         # Decoder
         feature_pred = self.predictor(tokens) # (B, N+1, D)
         dec_out = self.predictor_mlp(feature_pred.view(B, -1))
-        wp_pred = self.wp_predictor(dec_out).view(B, self.len_traj_pred, 2)
-        arrive_pred = self.arrive_predictor(dec_out).view(B, 1)
-        # Waypoint Prediction Processing
-        if self.output_coordinate_repr == 'euclidean':
-            # Predict deltas and compute cumulative sum
-            wp_pred = torch.cumsum(wp_pred, dim=1)
-            return wp_pred, arrive_pred, feature_pred[:, :-1], future_obs_enc
-        else:
-            raise NotImplementedError(f"Output coordinate representation {self.output_coordinate_repr} not implemented")
+        head_out = self.head(dec_out)
+        wp_pred = head_out[:, :-1].view(B, self.len_traj_pred, 2)
+        arrive_pred = head_out[:, -1:]
+        # Waypoint Prediction Processing, predict deltas and compute cumulative sum
+        wp_pred = trajectory_cumsum(self.cumsum_mat, wp_pred)
+        return wp_pred, arrive_pred, feature_pred[:, :-1], future_obs_enc
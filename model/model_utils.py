@@ -3,6 +3,34 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 
+def merge_output_heads_hook(state_dict, prefix, *args):
+    """
+    Load-state-dict pre-hook for models whose wp_predictor and arrive_predictor Linears were merged
+    into a single head. Concatenates the separate weights of older checkpoints into head.weight/bias.
+    Only the weights are remapped; see has_split_output_heads for the optimizer state.
+    """
+    for name in ['weight', 'bias']:
+        wp_key = prefix + 'wp_predictor.' + name
+        arrive_key = prefix + 'arrive_predictor.' + name
+        if wp_key in state_dict and arrive_key in state_dict:
+            state_dict[prefix + 'head.' + name] = torch.cat([state_dict.pop(wp_key), state_dict.pop(arrive_key)], dim=0)
+
+def has_split_output_heads(state_dict):
+    """
+    True if state_dict was saved before wp_predictor and arrive_predictor were merged into one head.
+    The optimizer state of such checkpoints is laid out for the old parameters and cannot be restored.
+    """
+    return any(k.endswith('arrive_predictor.weight') for k in state_dict)
+
+def trajectory_cumsum(cumsum_mat, deltas):
+    """
+    Cumulative sum of (B, T, 2) deltas over the trajectory as cumsum_mat @ deltas. Under autocast the
+    matmul would run in bf16/fp16 while torch.cumsum runs in fp32, so autocast is disabled here to keep
+    the accumulated waypoints in full precision.
+    """
+    with torch.autocast(device_type=deltas.device.type, enabled=False):
+        return torch.matmul(cumsum_mat.float(), deltas.float())
+
 class PolarEmbedding(nn.Module):
     def __init__(self, cfg):
         super(PolarEmbedding, self).__init__()
@@ -26,22 +54,20 @@ class PolarEmbedding(nn.Module):
             raise ValueError(f"Expected coords of shape (B, N, 2), but got {coords.shape}")
         
         x, y = coords[..., 0], coords[..., 1]  # Shape: (B, N)
-        r = torch.sqrt(x**2 + y**2).unsqueeze(-1)            # Shape: (B, N)
-        theta = torch.atan2(y, x).unsqueeze(-1)              # Shape: (B, N)
-        
-        enc = [r, theta] if self.include_input else []
+        r = torch.sqrt(x**2 + y**2).unsqueeze(-1)            # Shape: (B, N, 1)
+        theta = torch.atan2(y, x).unsqueeze(-1)              # Shape: (B, N, 1)
         
         # Expand freq_bands to (1, 1, num_freqs) for broadcasting
         freq_bands = self.freq_bands.view(1, 1, -1)  # Shape: (1, 1, num_freqs)
         
-        # Compute sin and cos for theta and r with frequency bands
-        enc.append(torch.sin(theta * freq_bands))  # Shape: (B, N, num_freqs)
-        enc.append(torch.cos(theta * freq_bands))  # Shape: (B, N, num_freqs)
-        enc.append(torch.sin(r * freq_bands))      # Shape: (B, N, num_freqs)
-        enc.append(torch.cos(r * freq_bands))      # Shape: (B, N, num_freqs)
+        # Compute sin and cos for theta and r with frequency bands in one call each,
+        # flattened to [sin(theta*f), cos(theta*f), sin(r*f), cos(r*f)]
+        phases = torch.stack([theta * freq_bands, r * freq_bands], dim=-2)   # Shape: (B, N, 2, num_freqs)
+        enc = torch.stack([phases.sin(), phases.cos()], dim=-2).flatten(-3)  # Shape: (B, N, 4 * num_freqs)
         
         # Concatenate all encodings along the last dimension
-        enc = torch.cat(enc, dim=-1)  # Shape: (B, N, D)
+        if self.include_input:
+            enc = torch.cat([r, theta, enc], dim=-1)  # Shape: (B, N, D)
         
         return enc
 
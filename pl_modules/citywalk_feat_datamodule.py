@@ -2,6 +2,7 @@
 
 import pytorch_lightning as pl
 from torch.utils.data import DataLoader
+from data.data_utils import loader_kwargs
 from data.citywalk_dataset import CityWalkSampler
 from data.citywalk_feat_dataset import CityWalkFeatDataset
 
@@ -11,23 +12,30 @@ class CityWalkFeatDataModule(pl.LightningDataModule):
         self.cfg = cfg
         self.batch_size = cfg.training.batch_size
         self.num_workers = cfg.data.num_workers
+        self.test_dataset = None
 
     def setup(self, stage=None):
         if stage == 'fit' or stage is None:
             self.train_dataset = CityWalkFeatDataset(self.cfg, mode='train')
             self.val_dataset = CityWalkFeatDataset(self.cfg, mode='val')
 
-        if stage == 'test' or stage is None:
+        # Keep an already built test set, e.g. from test.py's compile warmup, instead of parsing it again
+        if (stage == 'test' or stage is None) and self.test_dataset is None:
             self.test_dataset = CityWalkFeatDataset(self.cfg, mode='test')
 
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.batch_size,
-                          num_workers=self.num_workers, sampler=CityWalkSampler(self.train_dataset))
+        # The sampler shards videos by rank itself, so Lightning keeps it instead of wrapping it for DDP
+        trainer = self.trainer
+        sampler = CityWalkSampler(self.train_dataset, batch_size=self.batch_size, num_workers=self.num_workers,
+                                  num_replicas=trainer.world_size if trainer else 1,
+                                  rank=trainer.global_rank if trainer else 0)
+        return DataLoader(self.train_dataset, batch_size=self.batch_size, sampler=sampler,
+                          **loader_kwargs(self.num_workers))
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.batch_size,
-                          num_workers=self.num_workers, shuffle=False)
+        return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False,
+                          **loader_kwargs(self.num_workers))
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.batch_size,
-                          num_workers=self.num_workers, shuffle=False)
+        return DataLoader(self.test_dataset, batch_size=self.batch_size, shuffle=False,
+                          **loader_kwargs(self.num_workers))
@@ -2,12 +2,14 @@ import pytorch_lightning as pl
 import numpy as np
 import torch
 import torch.nn.functional as F
+from model.model_utils import has_split_output_heads
 from model.citywalker_feat import CityWalkerFeat
 import matplotlib
 import matplotlib.pyplot as plt
 matplotlib.use('Agg')
 plt.style.use('seaborn-v0_8')
 import os
+import warnings
 
 class CityWalkerFeatModule(pl.LightningModule):
     def __init__(self, cfg):
@@ -47,6 +49,21 @@ class CityWalkerFeatModule(pl.LightningModule):
 
     def forward(self, obs, cord, future_obs):
         return self.model(obs, cord, future_obs)
+
+    def on_load_checkpoint(self, checkpoint):
+        # Checkpoints from before the output heads were merged have their weights remapped on load,
+        # but their optimizer state no longer matches the parameters, so resume with a fresh one
+        if has_split_output_heads(checkpoint['state_dict']) and checkpoint.get('optimizer_states'):
+            warnings.warn("Checkpoint predates the merged output head; its optimizer state is discarded.")
+            checkpoint['optimizer_states'] = []
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Frames arrive as uint8 to cut dataloader IPC traffic, scale them on the device
+        # in the module's dtype (float32 under the mixed and 32-bit precisions the scripts use)
+        for key in ['video_frames', 'future_video_frames']:
+            if key in batch and batch[key].dtype == torch.uint8:
+                batch[key] = batch[key].to(self.dtype).mul_(1.0 / 255.0)
+        return batch
     
     def training_step(self, batch, batch_idx):
         obs = batch['video_frames']
@@ -122,6 +139,9 @@ class CityWalkerFeatModule(pl.LightningModule):
         
         if self.datatype == "citywalk":
             wp_pred, arrive_pred, _, _ = self(obs, cord, future_obs)
+            # wp_pred is already fp32 from trajectory_cumsum, but the arrival logits come out of the
+            # head Linear in the autocast dtype; threshold them in fp32
+            arrive_pred = arrive_pred.float()
             # Compute L1 loss for waypoints
             waypoints_target = batch['waypoints']
             l1_loss = F.l1_loss(wp_pred, waypoints_target, reduction='mean').item()
@@ -161,6 +181,9 @@ class CityWalkerFeatModule(pl.LightningModule):
         elif self.datatype == "teleop":
             category = batch['categories']
             wp_pred, arrive_pred, _, _ = self(obs, cord, future_obs)
+            # wp_pred is already fp32 from trajectory_cumsum, but the arrival logits come out of the
+            # head Linear in the autocast dtype; threshold them in fp32
+            arrive_pred = arrive_pred.float()
             wp_pred *= batch['step_scale'].unsqueeze(-1).unsqueeze(-1)
             
             # Compute L1 loss for waypoints
@@ -2,11 +2,13 @@ import pytorch_lightning as pl
 import numpy as np
 import torch
 import torch.nn.functional as F
+from model.model_utils import has_split_output_heads
 from model.citywalker import CityWalker
 import matplotlib
 import matplotlib.pyplot as plt
 matplotlib.use('Agg')
 import os
+import warnings
 
 class CityWalkerModule(pl.LightningModule):
     def __init__(self, cfg):
@@ -51,6 +53,20 @@ class CityWalkerModule(pl.LightningModule):
     def forward(self, obs, cord, gt_action=None):
         return self.model(obs, cord, gt_action)
     
+    def on_load_checkpoint(self, checkpoint):
+        # Checkpoints from before the output heads were merged have their weights remapped on load,
+        # but their optimizer state no longer matches the parameters, so resume with a fresh one
+        if has_split_output_heads(checkpoint['state_dict']) and checkpoint.get('optimizer_states'):
+            warnings.warn("Checkpoint predates the merged output head; its optimizer state is discarded.")
+            checkpoint['optimizer_states'] = []
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Frames arrive as uint8 to cut dataloader IPC traffic, scale them on the device
+        # in the module's dtype (float32 under the mixed and 32-bit precisions the scripts use)
+        if batch['video_frames'].dtype == torch.uint8:
+            batch['video_frames'] = batch['video_frames'].to(self.dtype).mul_(1.0 / 255.0)
+        return batch
+    
     def training_step(self, batch, batch_idx):
         obs = batch['video_frames']
         cord = batch['input_positions']
@@ -148,6 +164,9 @@ class CityWalkerModule(pl.LightningModule):
         if self.datatype == "citywalk":
             if self.output_coordinate_repr == "euclidean":
                 wp_pred, arrive_pred = self(obs, cord)
+                # wp_pred is already fp32 from trajectory_cumsum, but the arrival logits come out of the
+                # head Linear in the autocast dtype; threshold them in fp32
+                arrive_pred = arrive_pred.float()
                 # Compute L1 loss for waypoints
                 waypoints_target = batch['waypoints']
                 l1_loss = F.l1_loss(wp_pred, waypoints_target, reduction='mean').item()
@@ -187,6 +206,9 @@ class CityWalkerModule(pl.LightningModule):
         elif self.datatype == "urbannav":
             category = batch['categories']
             wp_pred, arrive_pred = self(obs, cord)
+            # wp_pred is already fp32 from trajectory_cumsum, but the arrival logits come out of the
+            # head Linear in the autocast dtype; threshold them in fp32
+            arrive_pred = arrive_pred.float()
             wp_pred *= batch['step_scale'].unsqueeze(-1).unsqueeze(-1)
             
             # Compute L1 loss for waypoints
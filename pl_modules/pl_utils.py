@@ -0,0 +1,13 @@
+import torch
+
+def amp_precision(amp):
+    """
+    Trainer precision for the training, fine-tuning and test scripts. bf16 autocast keeps the fp32 range
+    and needs no loss scaling; without bf16 support fall back to fp16 autocast. Mixed rather than bf16-true
+    precision, which would also cast the batch targets to bf16 and make the losses and metrics unreliable.
+    """
+    if not amp:
+        return 32
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return 'bf16-mixed'
+    return '16-mixed'
@@ -1,5 +1,6 @@
 import pytorch_lightning as pl
 from torch.utils.data import DataLoader
+from data.data_utils import loader_kwargs
 # from data.citywalk_dataset import CityWalkDataset
 from data.teleop_dataset import TeleopDataset
 
@@ -9,23 +10,25 @@ class TeleopDataModule(pl.LightningDataModule):
         self.cfg = cfg
         self.batch_size = cfg.training.batch_size
         self.num_workers = cfg.data.num_workers
+        self.test_dataset = None
 
     def setup(self, stage=None):
         if stage == 'fit' or stage is None:
             self.train_dataset = TeleopDataset(self.cfg, mode='train')
             self.val_dataset = TeleopDataset(self.cfg, mode='val')
 
-        if stage == 'test' or stage is None:
+        # Keep an already built test set, e.g. from test.py's compile warmup, instead of parsing it again
+        if (stage == 'test' or stage is None) and self.test_dataset is None:
             self.test_dataset = TeleopDataset(self.cfg, mode='test')
 
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.batch_size,
-                          num_workers=self.num_workers, shuffle=True)
+        return DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True,
+                          **loader_kwargs(self.num_workers))
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.batch_size,
-                          num_workers=self.num_workers, shuffle=False)
+        return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False,
+                          **loader_kwargs(self.num_workers))
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.batch_size,
-                          num_workers=self.num_workers, shuffle=False)
+        return DataLoader(self.test_dataset, batch_size=self.batch_size, shuffle=False,
+                          **loader_kwargs(self.num_workers))
@@ -8,6 +8,7 @@ from pl_modules.citywalk_datamodule import CityWalkDataModule
 from pl_modules.teleop_datamodule import TeleopDataModule
 from pl_modules.citywalker_module import CityWalkerModule
 from pl_modules.citywalker_feat_module import CityWalkerFeatModule
+from pl_modules.pl_utils import amp_precision
 from pl_modules.citywalk_feat_datamodule import CityWalkFeatDataModule
 from pytorch_lightning.strategies import DDPStrategy
 import torch
@@ -59,9 +60,8 @@ def find_latest_checkpoint(checkpoint_dir):
     if not checkpoint_files:
         raise FileNotFoundError(f"No checkpoint files found in directory: {checkpoint_dir}")
     
-    # Sort checkpoints by modification time (latest first)
-    checkpoint_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-    latest_checkpoint = checkpoint_files[0]
+    # Pick the most recently modified checkpoint, one stat() per file
+    latest_checkpoint = max(checkpoint_files, key=os.path.getmtime)
     return latest_checkpoint
 
 def main():
@@ -95,6 +95,8 @@ def main():
     else:
         raise ValueError(f"Invalid model: {cfg.model.type}")
     print(pl.utilities.model_summary.ModelSummary(model, max_depth=2))
+    if getattr(cfg.training, 'compile', False):
+        model = torch.compile(model, mode='reduce-overhead')
         
     # Initialize logger
     logger = None  # Default to no logger
@@ -124,6 +126,7 @@ def main():
 
     num_gpu = torch.cuda.device_count()
     # num_gpu = 1
+    find_unused_parameters = getattr(cfg.training, 'find_unused_parameters', False)
     
     # Set up Trainer
     if num_gpu > 1:
@@ -132,14 +135,20 @@ def main():
             max_epochs=cfg.training.max_epochs,
             logger=logger,  # Pass the logger (WandbLogger or None)
             devices=num_gpu,
-            precision='16-mixed' if cfg.training.amp else 32,
+            precision=amp_precision(cfg.training.amp),
             accelerator='gpu',
             callbacks=[
                 checkpoint_callback,
                 pl.callbacks.TQDMProgressBar(refresh_rate=cfg.logging.pbar_rate),
             ],
             log_every_n_steps=1,
-            strategy=DDPStrategy(find_unused_parameters=True)
+            # Only search for unused parameters when the config asks for it; otherwise let DDP
+            # assume a static graph and reuse its gradient buckets
+            strategy=DDPStrategy(
+                find_unused_parameters=find_unused_parameters,
+                static_graph=not find_unused_parameters,
+                gradient_as_bucket_view=True,
+            )
         )
     else:
         trainer = pl.Trainer(
@@ -147,7 +156,7 @@ def main():
             max_epochs=cfg.training.max_epochs,
             logger=logger,  # Pass the logger (WandbLogger or None)
             devices=num_gpu,
-            precision='16-mixed' if cfg.training.amp else 32,
+            precision=amp_precision(cfg.training.amp),
             accelerator='gpu',
             callbacks=[
                 checkpoint_callback,